@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+from fcntl import flock, LOCK_EX, LOCK_NB
 from gi import require_version
 from json import load
 from optparse import OptionParser
@@ -7,11 +8,15 @@ from re import sub
 from requests import get
 from signal import signal, SIGINT
 from shutil import which
+from tempfile import mkstemp
 
 import os
 import subprocess
 import vdf
 
+# How many times localconfig.vdf is re-read when it changes during update
+VDF_UPDATE_ATTEMPTS = 5
+
 
 class Colors:
     HEADER = "\033[95m"
@@ -80,6 +85,20 @@ def get_steam_libraries():
     return found_libraries
 
 
+def read_app_manifest(manifest_path):
+    """Returns APP_ID and name of the game from appmanifest file."""
+    with open(manifest_path) as manifest:
+        content = manifest.readlines()
+    app_id = ""
+    app_name = ""
+    for line in content:
+        if '"appid"' in line:
+            app_id = line.split('"')[3]
+        elif '"name"' in line:
+            app_name = line.split('"')[3]
+    return app_id, app_name
+
+
 def get_installed_games(libraries):
     """Returns dictionary where keys are APP_IDs and values are names of installed games."""
     found_games = {}
@@ -87,20 +106,43 @@ def get_installed_games(libraries):
         found_files = next(os.walk(library + "/steamapps"))[2]
         for filename in found_files:
             if "appmanifest" in filename and ".acf" in filename:
-                with open(library + "/steamapps/" + filename) as manifest:
-                    content = manifest.readlines()
-                app_id = ""
-                app_name = ""
-                for line in content:
-                    if '"appid"' in line:
-                        app_id = line.split('"')[3]
-                    elif '"name"' in line:
-                        app_name = line.split('"')[3]
+                app_id, app_name = read_app_manifest(library + "/steamapps/" + filename)
                 if app_id:
                     found_games[app_id] = app_name
     return found_games
 
 
+def get_installed_games_by_ids(libraries, app_ids):
+    """Returns dictionary of installed games limited to app_ids. Probes appmanifest files directly."""
+    found_games = {}
+    for app_id in app_ids:
+        for library in libraries:
+            manifest_path = library + "/steamapps/appmanifest_" + app_id + ".acf"
+            if os.path.isfile(manifest_path):
+                manifest_app_id, app_name = read_app_manifest(manifest_path)
+                if manifest_app_id:
+                    found_games[manifest_app_id] = app_name
+                break
+        if app_id not in found_games:
+            print_warning("[warning] Game with APP_ID %s is not installed." % app_id)
+    return found_games
+
+
+def parse_app_ids(values):
+    """Returns list of unique APP_IDs from --single values. Each value may contain comma-separated APP_IDs."""
+    app_ids = []
+    for value in values:
+        for app_id in value.split(","):
+            app_id = app_id.strip()
+            if not app_id:
+                continue
+            if not app_id.isdigit():
+                exit_with_message("Invalid APP_ID %s." % app_id)
+            if app_id not in app_ids:
+                app_ids.append(app_id)
+    return app_ids
+
+
 def get_fixable_games(games):
     """Returns dictionary of games that have icon in system icon_theme."""
     fixable = games.copy()
@@ -111,6 +153,90 @@ def get_fixable_games(games):
     return fixable
 
 
+def lock_file(path, create=True):
+    """Acquires exclusive advisory lock on file, creating it if allowed. Returns locked file descriptor.
+    Lock is released when the descriptor is closed or the process exits."""
+    while True:
+        descriptor = os.open(path, os.O_RDONLY | (os.O_CREAT if create else 0), 0o644)
+        try:
+            flock(descriptor, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            print("Waiting for another SIF run to finish (%s)." % path)
+            flock(descriptor, LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(descriptor), os.stat(path)):
+                return descriptor
+        except FileNotFoundError:
+            pass
+        # The file was replaced while waiting for the lock, so lock the new one
+        os.close(descriptor)
+
+
+def write_file_atomically(path, content):
+    """Writes content to temporary file, syncs it and renames it over path, so the file is never left partial."""
+    directory = os.path.dirname(path)
+    descriptor, temp_path = mkstemp(dir=directory, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w") as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        mode = os.stat(path).st_mode & 0o777 if os.path.isfile(path) else 0o644
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    directory_descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_descriptor)
+    finally:
+        os.close(directory_descriptor)
+
+
+def update_vdf_file(path, update):
+    """Applies update function to loaded vdf file and writes the result back under lock.
+    If the file changes between read and write (e.g. Steam saved it meanwhile), it is re-read and update is re-applied.
+    Returns updated data, or None if the file is missing or kept changing.
+    """
+    try:
+        descriptor = lock_file(path, create=False)
+    except FileNotFoundError:
+        return None
+    try:
+        for _ in range(VDF_UPDATE_ATTEMPTS):
+            try:
+                with open(path) as file:
+                    original = file.read()
+            except FileNotFoundError:
+                return None
+            loaded = vdf.loads(original)
+            update(loaded)
+            content = vdf.dumps(loaded, pretty=True)
+            if content == original:
+                return loaded
+            with open(path) as file:
+                if file.read() != original:
+                    continue
+            write_file_atomically(path, content)
+            return loaded
+    finally:
+        os.close(descriptor)
+    return None
+
+
+def lock_desktop_files_directory():
+    """Locks target directory against concurrent SIF runs. Returns descriptor held until exit."""
+    try:
+        os.makedirs(os.path.dirname(HIDDEN_DESKTOP_FILES_LOCK), exist_ok=True)
+        return lock_file(HIDDEN_DESKTOP_FILES_LOCK)
+    except OSError:
+        print_warning("[error] Locking of the target directory failed!")
+        print("   -", HIDDEN_DESKTOP_FILES_LOCK)
+        quit(1)
+
+
 print_buffer = []
 
 
@@ -132,17 +258,21 @@ def try_to_create_desktop_file(filename, app_name, app_id, wm_class, lo_fix=Fals
 
 
 def create_desktop_file(filename, app_name, app_id, wm_class):
-    """Creates hidden desktop file for Steam game."""
-    desktop_file = open(HIDDEN_DESKTOP_FILES_DIR + "/" + filename + ".desktop", "w+")
-    desktop_file.write("""[Desktop Entry]
+    """Creates hidden desktop file for Steam game. Existing file with the same content is left untouched."""
+    path = HIDDEN_DESKTOP_FILES_DIR + "/" + filename + ".desktop"
+    content = """[Desktop Entry]
 Type=Application
 Name=%s
 Icon=steam_icon_%s
 Exec=steam steam://rungameid/%s
 Terminal=false
 StartupWMClass=%s
-NoDisplay=true""" % (app_name, app_id, app_id, wm_class))
-    desktop_file.close()
+NoDisplay=true""" % (app_name, app_id, app_id, wm_class)
+    if os.path.isfile(path):
+        with open(path) as desktop_file:
+            if desktop_file.read() == content:
+                return
+    write_file_atomically(path, content)
 
 
 def clear_directory(directory):
@@ -183,60 +313,66 @@ def get_game_name(json):
     return None
 
 
-def fix_launch_option(app_id, wm_name, wm_name_alt=""):
-    """Add execution of fix-wm-class.sh file with wm_name of game as argument."""
-    for conf_file in localconfig_paths:
-        loaded = vdf.load(open(conf_file))
+def get_localconfig_apps(loaded):
+    """Returns Apps dictionary from loaded localconfig.vdf file."""
+    steam = get_from_dict(loaded, ["UserLocalConfigStore", "Software", "Valve", "Steam"], {})
+    return get_from_dict(steam, ["Apps"], {})
 
-        steam = get_from_dict(loaded, ["UserLocalConfigStore", "Software", "Valve", "Steam"], {})
-        apps = get_from_dict(steam, ["Apps"], {})
 
-        if not apps:
-            print_warning("[warning] No Apps key found in %s" % conf_file)
-            continue
-
-        if app_id in apps.keys():
-            app = apps[app_id]
-            if "LaunchOptions" not in app.keys():
-                app["LaunchOptions"] = ""
-            app["LaunchOptions"] = sub("\\s/.*fix-wm-class\\.sh.*?;", "", app["LaunchOptions"])
-            app["LaunchOptions"] = sub("%command%", "", app["LaunchOptions"])
-            launch_options = app["LaunchOptions"].strip()
-            script = str(WM_CLASS_FIXER_SCRIPT)
-            if wm_name_alt:
-                app["LaunchOptions"] = '%s %s "%s" "%s" %%command%%;' % (
-                    launch_options,
-                    script,
-                    wm_name,
-                    wm_name_alt,
-                )
-            else:
+def fix_launch_options(fixes):
+    """Add execution of fix-wm-class.sh file with wm_name of game as argument.
+    Fixes is dictionary where keys are APP_IDs and values are (wm_name, wm_name_alt) tuples.
+    Returns False if some localconfig.vdf file couldn't be updated."""
+    success = True
+    for conf_file in localconfig_paths:
+
+        def update(loaded):
+            apps = get_localconfig_apps(loaded)
+
+            for app_id, (wm_name, wm_name_alt) in fixes.items():
+                if app_id not in apps.keys():
+                    continue
+                app = apps[app_id]
+                if "LaunchOptions" not in app.keys():
+                    app["LaunchOptions"] = ""
+                app["LaunchOptions"] = sub("\\s/.*fix-wm-class\\.sh.*?;", "", app["LaunchOptions"])
+                app["LaunchOptions"] = sub("%command%", "", app["LaunchOptions"])
+                launch_options = app["LaunchOptions"].strip()
+                script = str(WM_CLASS_FIXER_SCRIPT)
                 app["LaunchOptions"] = '%s %s "%s" "%s" %%command%%;' % (
                     launch_options,
                     script,
                     wm_name,
-                    wm_name,
+                    wm_name_alt or wm_name,
                 )
-        vdf.dump(loaded, open(conf_file, "w"), pretty=True)
+
+        loaded = update_vdf_file(conf_file, update)
+        if loaded is None:
+            print_warning("[warning] Couldn't update %s" % conf_file)
+            success = False
+        elif not get_localconfig_apps(loaded):
+            print_warning("[warning] No Apps key found in %s" % conf_file)
+    return success
 
 
 def restore_launch_options():
-    """Removes changes made by "fix_launch_option" function."""
+    """Removes changes made by "fix_launch_options" function. Returns False if some file couldn't be updated."""
+    success = True
     for conf_file in localconfig_paths:
-        loaded = vdf.load(open(conf_file))
 
-        steam = get_from_dict(loaded, ["UserLocalConfigStore", "Software", "Valve", "Steam"], {})
-        apps = get_from_dict(steam, ["Apps"], {})
+        def update(loaded):
+            apps = get_localconfig_apps(loaded)
 
-        if not apps:
-            continue
+            for app_id in apps.keys():
+                app = apps[app_id]
+                if "LaunchOptions" in app.keys():
+                    app["LaunchOptions"] = sub("\\s/.*fix-wm-class\\.sh.*?;", " %command%", app["LaunchOptions"])
+                    app["LaunchOptions"] = app["LaunchOptions"].strip()
 
-        for app_id in apps.keys():
-            app = apps[app_id]
-            if "LaunchOptions" in app.keys():
-                app["LaunchOptions"] = sub("\\s/.*fix-wm-class\\.sh.*?;", " %command%", app["LaunchOptions"])
-                app["LaunchOptions"] = app["LaunchOptions"].strip()
-        vdf.dump(loaded, open(conf_file, "w"), pretty=True)
+        if update_vdf_file(conf_file, update) is None:
+            print_warning("[warning] Couldn't update %s" % conf_file)
+            success = False
+    return success
 
 
 def find_processes(process_name):
@@ -384,8 +520,9 @@ if __name__ == "__main__":
     parser.add_option(
         "-s",
         "--single",
+        action="append",
         dest="single",
-        help="fix only one icon with specific APP_ID",
+        help="fix only icons of games with specific APP_IDs (comma-separated or repeated)",
         metavar="APP_ID",
     )
     parser.add_option(
@@ -447,6 +584,8 @@ if __name__ == "__main__":
     REAL_PATH = os.path.dirname(os.path.realpath(__file__))
     STEAM_CONFIG_FILE = STEAM_INSTALL_DIR + "/config/config.vdf"
     HIDDEN_DESKTOP_FILES_DIR = HOME + "/.local/share/applications/steam-icons-fixed"
+    SIF_RUNTIME_DIR = os.getenv("XDG_RUNTIME_DIR") or (os.getenv("XDG_CACHE_HOME") or HOME + "/.cache") + "/sif"
+    HIDDEN_DESKTOP_FILES_LOCK = SIF_RUNTIME_DIR + "/sif-steam-icons-fixed.lock"
     DATABASE_FILE = REAL_PATH + "/database.json"
     WM_CLASS_FIXER_SCRIPT = REAL_PATH + "/fix-wm-class.sh"
 
@@ -521,11 +660,18 @@ if __name__ == "__main__":
     # --restore
 
     if options.restore:
+        if os.path.isdir(HIDDEN_DESKTOP_FILES_DIR):
+            # Held until exit, so concurrent runs don't interleave changes in target directory
+            desktop_files_lock = lock_desktop_files_directory()
+        # Another run may have restored everything while we were waiting for the lock
         if os.path.isdir(HIDDEN_DESKTOP_FILES_DIR):
             print("Removing all changes and restoring default settings.")
             clear_directory(HIDDEN_DESKTOP_FILES_DIR)
             if not steam_detect():
-                restore_launch_options()
+                if not restore_launch_options():
+                    # Keep the directory, so the next --restore run tries it again
+                    print_warning("\nCouldn't restore all default launch options. Exit Steam and try it again.")
+                    quit(1)
                 print("\nDefault Steam launch options restored.")
                 os.rmdir(HIDDEN_DESKTOP_FILES_DIR)
                 print("\nDirectory %s removed." % HIDDEN_DESKTOP_FILES_DIR)
@@ -537,8 +683,14 @@ if __name__ == "__main__":
             print("Default settings are already restored. Nothing to do here.")
         quit()
 
-    raw_installed_games = get_installed_games(library_folders).items()
-    installed_games = {key: val for key, val in sorted(raw_installed_games, key=lambda item: int(item[0]))}
+    # --single only probes manifests of selected games instead of scanning whole libraries.
+    # --games and --icons always list the whole library.
+
+    if options.single and not options.games and not options.icons:
+        found_games = get_installed_games_by_ids(library_folders, parse_app_ids(options.single))
+    else:
+        found_games = get_installed_games(library_folders)
+    installed_games = {key: val for key, val in sorted(found_games.items(), key=lambda item: int(item[0]))}
     fixable_games = get_fixable_games(installed_games)
 
     # --games
@@ -610,12 +762,6 @@ if __name__ == "__main__":
             print(f"{key} - {name}")
         quit()
 
-    # --single
-
-    if options.single:
-        if options.single in fixable_games:
-            fixable_games = {k: v for k, v in fixable_games.items() if k == options.single}
-
     if not fixable_games:
         print_warning("No games found to fix.")
         quit()
@@ -623,6 +769,8 @@ if __name__ == "__main__":
     # Look for target directory or create new
 
     if not options.pretend:
+        # Held until exit, so concurrent runs don't interleave changes in target directory
+        desktop_files_lock = lock_desktop_files_directory()
         if os.path.isdir(HIDDEN_DESKTOP_FILES_DIR):
             verbose_print("[ok] Found target directory:")
             verbose_print("   - %s\n" % HIDDEN_DESKTOP_FILES_DIR)
@@ -667,6 +815,7 @@ if __name__ == "__main__":
     # All important work here
 
     launch_option_counter = 0
+    launch_option_fixes = {}
 
     for game in fixable_games:
         game_name = fixable_games[game]
@@ -708,7 +857,7 @@ if __name__ == "__main__":
                 game_wm_name_alt = ""
                 if len(split) > 1:
                     game_wm_name_alt = split[1]
-                fix_launch_option(game, game_wm_name, game_wm_name_alt)
+                launch_option_fixes[game] = (game_wm_name, game_wm_name_alt)
                 try_to_create_desktop_file(
                     file_name,
                     fixable_games[game],
@@ -717,9 +866,17 @@ if __name__ == "__main__":
                     True,
                 )
 
+    # Each localconfig.vdf is read and written only once for all games
+
+    launch_options_fixed = True
+    if launch_option_fixes and not options.pretend:
+        launch_options_fixed = fix_launch_options(launch_option_fixes)
+
     if launch_option_counter > 0:
         if steam_detected:
             print_warning("\nSome games couldn't be fixed due to running Steam.\nExit Steam and try it again.")
+        elif not launch_options_fixed:
+            print_warning("\nSome launch options couldn't be changed.\nExit Steam and try it again.")
         else:
             print("\n * - added fix to game launch options. Double check your launch options just in case.")
 
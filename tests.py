@@ -1,5 +1,15 @@
 import json
+import os
+import sif
+import tempfile
+import threading
 import unittest
+import vdf
+
+from contextlib import redirect_stdout
+from fcntl import flock
+from io import StringIO
+from unittest.mock import patch
 
 DATABASE_FILE = "database.json"
 
@@ -23,5 +33,158 @@ class DatabaseValidity(unittest.TestCase):
         self.assertEqual(keys, sorted_keys)
 
 
+class SingleGames(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.libraries = []
+        for library, games in [("first", {"10": "Counter-Strike", "620": "Portal 2"}), ("second", {"620": "Copy"})]:
+            library_path = os.path.join(self.directory.name, library)
+            os.makedirs(library_path + "/steamapps")
+            for app_id, name in games.items():
+                with open(library_path + "/steamapps/appmanifest_" + app_id + ".acf", "w") as manifest:
+                    manifest.write('"AppState"\n{\n\t"appid"\t\t"%s"\n\t"name"\t\t"%s"\n}\n' % (app_id, name))
+            self.libraries.append(library_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_app_ids_split_and_deduplicated(self):
+        self.assertEqual(sif.parse_app_ids(["620,10", " 620 ", "70,,"]), ["620", "10", "70"])
+
+    def test_invalid_app_id_rejected(self):
+        with redirect_stdout(StringIO()):
+            with self.assertRaises(SystemExit):
+                sif.parse_app_ids(["620,../config"])
+
+    def test_libraries_probed_in_order(self):
+        with redirect_stdout(StringIO()):
+            games = sif.get_installed_games_by_ids(self.libraries, ["620"])
+
+        self.assertEqual(games, {"620": "Portal 2"})
+
+    def test_not_installed_games_reported(self):
+        output = StringIO()
+        with redirect_stdout(output):
+            games = sif.get_installed_games_by_ids(self.libraries, ["10", "70"])
+
+        self.assertEqual(games, {"10": "Counter-Strike"})
+        self.assertIn("APP_ID 70 is not installed", output.getvalue())
+        self.assertNotIn("APP_ID 10 ", output.getvalue())
+
+    def test_same_games_as_full_scan(self):
+        games = sif.get_installed_games(self.libraries[:1])
+
+        self.assertEqual(sif.get_installed_games_by_ids(self.libraries[:1], list(games)), games)
+
+
+class AtomicWrites(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "localconfig.vdf")
+        with open(self.path, "w") as file:
+            file.write(vdf.dumps({"Apps": {"10": {"LaunchOptions": ""}}}, pretty=True))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_mode_preserved(self):
+        os.chmod(self.path, 0o600)
+        sif.write_file_atomically(self.path, "content")
+
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        with open(self.path) as file:
+            self.assertEqual(file.read(), "content")
+
+    def test_no_leftover_temp_files(self):
+        sif.update_vdf_file(self.path, lambda loaded: loaded.update({"key": "value"}))
+        sif.write_file_atomically(self.path, "content")
+
+        self.assertEqual(os.listdir(self.directory.name), ["localconfig.vdf"])
+
+    def test_unchanged_file_not_rewritten(self):
+        before = os.stat(self.path)
+        loaded = sif.update_vdf_file(self.path, lambda loaded: None)
+        after = os.stat(self.path)
+
+        self.assertIsNotNone(loaded)
+        self.assertEqual((before.st_ino, before.st_mtime_ns), (after.st_ino, after.st_mtime_ns))
+
+    def test_missing_file_not_created(self):
+        os.remove(self.path)
+
+        self.assertIsNone(sif.update_vdf_file(self.path, lambda loaded: loaded.update({"key": "value"})))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_change_between_read_and_write_is_merged(self):
+        calls = []
+
+        def update(loaded):
+            if not calls:
+                # Simulate Steam saving the file while SIF is updating it
+                with open(self.path, "w") as file:
+                    file.write(vdf.dumps({"Apps": {"10": {"LaunchOptions": ""}}, "steam": "1"}, pretty=True))
+            calls.append(True)
+            loaded["sif"] = "1"
+
+        sif.update_vdf_file(self.path, update)
+
+        with open(self.path) as file:
+            loaded = vdf.load(file)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(loaded["steam"], "1")
+        self.assertEqual(loaded["sif"], "1")
+
+    def test_file_changing_all_the_time_fails(self):
+        def update(loaded):
+            with open(self.path, "a") as file:
+                file.write("\n")
+            loaded["sif"] = "1"
+
+        self.assertIsNone(sif.update_vdf_file(self.path, update))
+
+    def test_concurrent_updates_all_kept(self):
+        def add_key(key):
+            sif.update_vdf_file(self.path, lambda loaded: loaded.update({key: "1"}))
+
+        threads = [threading.Thread(target=add_key, args=("key%d" % i,)) for i in range(8)]
+        with redirect_stdout(StringIO()):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        with open(self.path) as file:
+            loaded = vdf.load(file)
+        self.assertEqual({"key%d" % i for i in range(8)}, set(loaded.keys()) - {"Apps"})
+
+    def test_lock_follows_replaced_file(self):
+        old_stat = os.stat(self.path)
+        waiting = threading.Event()
+        locked_stats = []
+        acquired = []
+        descriptor = sif.lock_file(self.path, create=False)
+
+        def record_flock(lock_descriptor, operation):
+            locked_stats.append(os.fstat(lock_descriptor))
+            return flock(lock_descriptor, operation)
+
+        def wait_for_lock():
+            acquired.append(sif.lock_file(self.path, create=False))
+
+        with patch("sif.flock", record_flock), patch("sif.print", lambda *_: waiting.set(), create=True):
+            thread = threading.Thread(target=wait_for_lock)
+            thread.start()
+            self.assertTrue(waiting.wait(5))
+            sif.write_file_atomically(self.path, "content")
+            os.close(descriptor)
+            thread.join(5)
+
+        new_stat = os.stat(self.path)
+        self.assertFalse(os.path.samestat(old_stat, new_stat))
+        self.assertTrue(os.path.samestat(locked_stats[0], old_stat))
+        self.assertTrue(os.path.samestat(os.fstat(acquired[0]), new_stat))
+        os.close(acquired[0])
+
+
 if __name__ == "__main__":
     unittest.main()